@@ -1,10 +1,17 @@
 import time
 import os
+import math
+import re
 import sys
 import signal
 import faulthandler
-from attrdict import AttrDict
+import threading
+from typing import NamedTuple
+from collections import Counter
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from qbittorrentapi import Client, TorrentStates
+from requests.adapters import HTTPAdapter
 from prometheus_client import start_http_server
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
 import logging
@@ -15,6 +22,87 @@ from pythonjsonlogger import jsonlogger
 faulthandler.enable()
 logger = logging.getLogger()
 
+def _statuses_by_torrent_state(statuses):
+    return {
+        state.value: tuple(
+            status for status in statuses if getattr(state, f"is_{status}")
+        )
+        for state in TorrentStates
+    }
+
+_FAMILY_BY_TYPE = {
+    "counter": CounterMetricFamily,
+    "gauge": GaugeMetricFamily,
+}
+
+# (metric name, torrent field, metric type, help) of the per torrent metrics
+TORRENT_METRIC_SPECS = [
+    ("torrents_info_added_on", "added_on", "gauge", "Time (Unix Epoch) when the torrent was added to the client"),
+    ("torrents_info_availability", "availability", "gauge", "Percentage of file pieces currently available"),
+    ("torrents_info_downloaded", "downloaded", "counter", "Amount of data downloaded"),
+    ("torrents_info_num_complete", "num_complete", "gauge", "Number of seeds in the swarm"),
+    ("torrents_info_num_incomplete", "num_incomplete", "gauge", "Number of leechers in the swarm"),
+    ("torrents_info_num_leechs", "num_leechs", "gauge", "Number of leechers connected to"),
+    ("torrents_info_num_seeds", "num_seeds", "gauge", "Number of seeds connected to"),
+    ("torrents_info_ratio", "ratio", "gauge", "Torrent share ratio. Max ratio value: 9999."),
+    ("torrents_seeding_time", "seeding_time", "gauge", "Torrent elapsed time while complete (seconds)"),
+    ("torrents_info_size", "size", "gauge", "Total size (bytes) of files selected for download"),
+    ("torrents_info_total_size", "total_size", "gauge", "Total size (bytes) of all file in this torrent (including unselected ones)"),
+    ("torrents_info_time_active", "time_active", "gauge", "Total active time (seconds)"),
+    ("torrents_info_uploaded", "uploaded", "counter", "Amount of data uploaded"),
+]
+
+class Metric(NamedTuple):
+    name: str
+    value: float
+    labels: tuple = ()
+    help: str = ""
+    type: str = "gauge"
+
+def _update_fields(target, source, fields, interned_fields=()):
+    for field in fields:
+        if field in source:
+            target[field] = source[field]
+
+    # Values repeated across many torrents/peers end up sharing one string
+    for field in interned_fields:
+        if isinstance(source.get(field), str):
+            target[field] = sys.intern(source[field])
+
+class PooledClient(Client):
+    HTTP_POOL_SIZE = 32
+    HTTP_TIMEOUT = 10
+
+    @property
+    def _session(self):
+        # qbittorrentapi rebuilds its session after every re-login, so the
+        # pooled adapter has to be mounted whenever a new one is created
+        if self._requests_session:
+            return self._requests_session
+
+        session = super()._session
+        # Only the pool is resized, qbittorrentapi's own retry policy is kept
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.HTTP_POOL_SIZE,
+            max_retries=session.get_adapter("http://").max_retries,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    def _request(self, http_method, api_namespace, api_method, **kwargs):
+        # qbittorrentapi sends no timeout, a hung server would block forever
+        requests_params = dict(kwargs.get("requests_params") or {})
+        requests_params.setdefault("timeout", self.HTTP_TIMEOUT)
+        kwargs["requests_params"] = requests_params
+
+        response = super()._request(http_method, api_namespace, api_method, **kwargs)
+        # Large torrent and peer lists parse noticeably faster with orjson
+        response.json = lambda **_: orjson.loads(response.content)
+        return response
+
 class QbittorrentMetricsCollector():
     TORRENT_STATUSES = [
         "downloading",
@@ -24,426 +112,474 @@ class QbittorrentMetricsCollector():
         "errored",
         "paused",
     ]
+    METRIC_NAMES = [
+        "up",
+        "connected",
+        "firewalled",
+        "dht_nodes",
+        "dl_info_data",
+        "up_info_data",
+        "average_time_queue",
+        "read_cache_hits",
+        "total_buffers_size",
+        "total_peer_connections",
+        "total_wasted",
+        "write_cache_overload",
+        "scrape_error",
+        "torrents_count",
+        "peers_downloaded",
+        "peers_uploaded",
+        "peers_progress",
+        "peers_relevance",
+    ] + [name for name, _, _, _ in TORRENT_METRIC_SPECS]
+    # Only these fields are kept from the torrents and peers sent by qBittorrent
+    TORRENT_FIELDS = (
+        "added_on",
+        "availability",
+        "category",
+        "downloaded",
+        "name",
+        "num_complete",
+        "num_incomplete",
+        "num_leechs",
+        "num_seeds",
+        "ratio",
+        "seeding_time",
+        "size",
+        "state",
+        "time_active",
+        "total_size",
+        "uploaded",
+    )
+    TORRENT_INTERNED_FIELDS = ("category", "name", "state")
+    PEER_FIELDS = (
+        "country",
+        "country_code",
+        "downloaded",
+        "ip",
+        "port",
+        "progress",
+        "relevance",
+        "uploaded",
+    )
+    PEER_INTERNED_FIELDS = ("country", "country_code")
+    # Statuses matching each qBittorrent torrent state, resolved once at import
+    TORRENT_STATE_STATUSES = _statuses_by_torrent_state(TORRENT_STATUSES)
 
     def __init__(self, config):
         self.config = config
         self.torrents = None
-        self.client = Client(
+        self.server_state = None
+        self.categories = None
+        # qBittorrent sync maindata only sends what changed since the last
+        # response id (rid), so the full state is rebuilt locally
+        self._maindata_rid = 0
+        self._torrents_state = {}
+        self._server_state = {}
+        self._categories_state = {}
+        self._cache = {}
+        self._names = {
+            name: f"{config['metrics_prefix']}_{name}" for name in self.METRIC_NAMES
+        }
+        self._cache_ttl = config["cache_ttl"]
+        self.client = PooledClient(
             host=config["host"],
             port=config["port"],
             username=config["username"],
             password=config["password"],
         )
+        self._pool = ThreadPoolExecutor(
+            max_workers=min(config["peers_concurrency"], PooledClient.HTTP_POOL_SIZE),
+        )
+
+        # Metrics are gathered in the background and scrapes are served from
+        # the last snapshot, so they don't wait on qBittorrent
+        self._collect_interval = config["collect_interval"]
+        self._snapshot_families = []
+        self._snapshot_time = time.monotonic()
+        self._snapshot_lock = threading.Lock()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def _cached(self, key, fetch):
+        # Reuse the last API response for `key` while it is younger than the cache TTL
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached is not None and now - cached[0] < self._cache_ttl:
+            return cached[1]
+
+        value = fetch()
+        self._cache[key] = (now, value)
+        return value
+
+    def _sync_maindata(self):
+        response = self.client.sync_maindata(rid=self._maindata_rid, SIMPLE_RESPONSES=True)
+
+        if response.get("full_update"):
+            self._torrents_state = {}
+            self._server_state = {}
+            self._categories_state = {}
+
+        for torrent_hash, torrent in response.get("torrents", {}).items():
+            _update_fields(
+                self._torrents_state.setdefault(torrent_hash, {"hash": torrent_hash}),
+                torrent,
+                self.TORRENT_FIELDS,
+                self.TORRENT_INTERNED_FIELDS,
+            )
+        for torrent_hash in response.get("torrents_removed", []):
+            self._torrents_state.pop(torrent_hash, None)
+        self._server_state.update(response.get("server_state", {}))
+        for name, category in response.get("categories", {}).items():
+            self._categories_state.setdefault(name, {}).update(category)
+        for name in response.get("categories_removed", []):
+            self._categories_state.pop(name, None)
+
+        self._maindata_rid = response["rid"]
+
+    def _sync_torrent_peers(self, torrent_hash):
+        # qBittorrent keeps a single torrentPeers rid per Web UI session, not
+        # one per torrent, so with many torrents peers are always fetched in full
+        response = self.client.sync_torrent_peers(torrent_hash=torrent_hash, SIMPLE_RESPONSES=True)
+
+        peers = {}
+        for peer_id, peer in response.get("peers", {}).items():
+            _update_fields(
+                peers.setdefault(peer_id, {}),
+                peer,
+                self.PEER_FIELDS,
+                self.PEER_INTERNED_FIELDS,
+            )
+
+        return peers
+
+    def _refresh_loop(self):
+        while True:
+            # `up` only tells whether qBittorrent answered, failures while
+            # building the metrics are reported on their own gauge
+            families = []
+            scrape_error = False
+            try:
+                for family in self._collect_families():
+                    families.append(family)
+            except Exception as e:
+                logger.error(f"Couldn't collect metrics: {e}")
+                scrape_error = True
+            families.append(self._metric_family(Metric(
+                name=self._names["scrape_error"],
+                value=scrape_error,
+                help="Whether if the exporter failed to build some of the metrics",
+            )))
+
+            with self._snapshot_lock:
+                self._snapshot_families = families
+                self._snapshot_time = time.monotonic()
+
+            time.sleep(self._collect_interval)
 
     def collect(self):
+        with self._snapshot_lock:
+            families = self._snapshot_families
+            snapshot_time = self._snapshot_time
+
+        # The refresh thread is stuck waiting on qBittorrent, report it as down
+        if time.monotonic() - snapshot_time > 2 * self._collect_interval:
+            families = [self._metric_family(self._up_metric(False, ""))]
+
+        yield from families
+
+    def _collect_families(self):
         try:
-            self.torrents = self.client.torrents.info()
+            self._sync_maindata()
+            self.torrents = list(self._torrents_state.values())
+            self.server_state = self._server_state
+            self.categories = self._categories_state
         except Exception as e:
             logger.error(f"Couldn't get server info: {e}")
+            self.torrents = None
+            self.server_state = None
+            self.categories = None
 
         metrics = self.get_qbittorrent_metrics()
 
         for metric in metrics:
-            name = metric["name"]
-            value = metric["value"]
-            help_text = metric.get("help", "")
-            labels = metric.get("labels", {})
-            metric_type = metric.get("type", "gauge")
-
-            if metric_type == "counter":
-                prom_metric = CounterMetricFamily(name, help_text, labels=labels.keys())
-            else:
-                prom_metric = GaugeMetricFamily(name, help_text, labels=labels.keys())
-            prom_metric.add_metric(value=value, labels=labels.values())
-            yield prom_metric
+            yield self._metric_family(metric)
+
+        # The server couldn't be reached, don't bother with the remaining requests
+        if self.torrents is None:
+            return
+
+        # Per torrent and per peer metrics are built straight into their families
+        yield from self.get_qbittorrent_torrent_tags_metrics()
+        yield from self.get_qbittorrent_torrents_metrics()
+        yield from self.get_qbittorrent_peers_metrics()
+
+    @staticmethod
+    def _metric_family(metric):
+        label_names = [label for label, _ in metric.labels]
+        label_values = [value for _, value in metric.labels]
+
+        family = _FAMILY_BY_TYPE[metric.type]
+        prom_metric = family(metric.name, metric.help, labels=label_names)
+        prom_metric.add_metric(value=metric.value, labels=label_values)
+        return prom_metric
+
+    def _up_metric(self, up, version):
+        return Metric(
+            name=self._names["up"],
+            value=up,
+            labels=(("version", version),),
+            help="Whether if server is alive or not",
+        )
 
     def get_qbittorrent_metrics(self):
-        metrics = []
-        metrics.extend(self.get_qbittorrent_status_metrics())
-        metrics.extend(self.get_qbittorrent_sync_main_metrics())
-        metrics.extend(self.get_qbittorrent_torrent_tags_metrics())
-        metrics.extend(self.get_qbittorrent_torrents_metrics())
-        metrics.extend(self.get_qbittorrent_peers_metrics())
-
-        return metrics
+        # Lazily, so status metrics are kept even if sync main ones fail
+        yield from self.get_qbittorrent_status_metrics()
+        yield from self.get_qbittorrent_sync_main_metrics()
 
     def get_qbittorrent_status_metrics(self):
+        response = self.server_state
+        version = ""
+
         # Fetch data from API
-        try:
-            response = self.client.transfer.info
-            version = self.client.app.version
-            self.torrents = self.client.torrents.info()
-        except Exception as e:
-            logger.error(f"Couldn't get server info: {e}")
-            response = None
-            version = ""
+        if response is not None:
+            # The server answered sync maindata, so it is still up without a version
+            try:
+                version = self._cached("app_version", lambda: self.client.app.version)
+            except Exception as e:
+                logger.error(f"Couldn't fetch server version: {e}")
+
+        up = self._up_metric(response is not None, version)
+        if response is None:
+            return [up]
 
         return [
-            {
-                "name": f"{self.config['metrics_prefix']}_up",
-                "value": response is not None,
-                "labels": {"version": version},
-                "help": "Whether if server is alive or not",
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_connected",
-                "value": response.get("connection_status", "") == "connected",
-                "help": "Whether if server is connected or not",
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_firewalled",
-                "value": response.get("connection_status", "") == "firewalled",
-                "help": "Whether if server is under a firewall or not",
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_dht_nodes",
-                "value": response.get("dht_nodes", 0),
-                "help": "DHT nodes connected to",
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_dl_info_data",
-                "value": response.get("dl_info_data", 0),
-                "help": "Data downloaded this session (bytes)",
-                "type": "counter"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_up_info_data",
-                "value": response.get("up_info_data", 0),
-                "help": "Data uploaded this session (bytes)",
-                "type": "counter"
-            },
+            up,
+            Metric(
+                name=self._names["connected"],
+                value=response.get("connection_status", "") == "connected",
+                help="Whether if server is connected or not",
+            ),
+            Metric(
+                name=self._names["firewalled"],
+                value=response.get("connection_status", "") == "firewalled",
+                help="Whether if server is under a firewall or not",
+            ),
+            Metric(
+                name=self._names["dht_nodes"],
+                value=response.get("dht_nodes", 0),
+                help="DHT nodes connected to",
+            ),
+            Metric(
+                name=self._names["dl_info_data"],
+                value=response.get("dl_info_data", 0),
+                help="Data downloaded this session (bytes)",
+                type="counter",
+            ),
+            Metric(
+                name=self._names["up_info_data"],
+                value=response.get("up_info_data", 0),
+                help="Data uploaded this session (bytes)",
+                type="counter",
+            ),
         ]
     
     def get_qbittorrent_sync_main_metrics(self):
-        try:
-            sync_main_response = self.client.sync_maindata()
-        except Exception as e:
-            logger.error(f"Couldn't fetch sync maindata: {e}")
-            return []
-        
-        if not sync_main_response:
-            return []
-
-        server_state = sync_main_response["server_state"]
+        server_state = self.server_state
         if not server_state:
             return []
 
         return [
-            {
-                "name": f"{self.config['metrics_prefix']}_average_time_queue",
-                "value": server_state["average_time_queue"],
-                "help": "Average disk job time in ms",
-                "type": "gauge"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_read_cache_hits",
-                "value": server_state["read_cache_hits"],
-                "help": "Read cache hits in percent",
-                "type": "gauge"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_total_buffers_size",
-                "value": server_state["total_buffers_size"],
-                "help": "Total buffer size in bytes",
-                "type": "gauge"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_total_peer_connections",
-                "value": server_state["total_peer_connections"],
-                "help": "Total peer connections",
-                "type": "gauge"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_total_wasted",
-                "value": server_state["total_wasted_session"],
-                "help": "Total wasted in bytes",
-                "type": "counter"
-            },
-            {
-                "name": f"{self.config['metrics_prefix']}_write_cache_overload",
-                "value": server_state["write_cache_overload"],
-                "help": "Write cache overload in percent",
-                "type": "gauge"
-            },
+            Metric(
+                name=self._names["average_time_queue"],
+                value=server_state["average_time_queue"],
+                help="Average disk job time in ms",
+                type="gauge",
+            ),
+            Metric(
+                name=self._names["read_cache_hits"],
+                value=server_state["read_cache_hits"],
+                help="Read cache hits in percent",
+                type="gauge",
+            ),
+            Metric(
+                name=self._names["total_buffers_size"],
+                value=server_state["total_buffers_size"],
+                help="Total buffer size in bytes",
+                type="gauge",
+            ),
+            Metric(
+                name=self._names["total_peer_connections"],
+                value=server_state["total_peer_connections"],
+                help="Total peer connections",
+                type="gauge",
+            ),
+            Metric(
+                name=self._names["total_wasted"],
+                value=server_state["total_wasted_session"],
+                help="Total wasted in bytes",
+                type="counter",
+            ),
+            Metric(
+                name=self._names["write_cache_overload"],
+                value=server_state["write_cache_overload"],
+                help="Write cache overload in percent",
+                type="gauge",
+            ),
         ]
 
 
     def get_qbittorrent_torrent_tags_metrics(self):
-        try:
-            categories = self.client.torrent_categories.categories
-        except Exception as e:
-            logger.error(f"Couldn't fetch categories: {e}")
-            return []
-
         if not self.torrents:
             return []
 
-        metrics = []
-        categories.Uncategorized = AttrDict({'name': 'Uncategorized', 'savePath': ''})
-        for category in categories:
-            category_torrents = [t for t in self.torrents if t['category'] == category or (category == "Uncategorized" and t['category'] == "")]
-
+        # Count torrents per (category, state), then expand states into statuses
+        state_counts = Counter((t['category'] or "Uncategorized", t['state']) for t in self.torrents)
+        counts = Counter()
+        for (category, state), count in state_counts.items():
+            for status in self.TORRENT_STATE_STATUSES.get(state, ()):
+                counts[(category, status)] += count
+
+        torrents_count = GaugeMetricFamily(
+            self._names["torrents_count"],
+            "Number of torrents for each status and category",
+            labels=["status", "category"],
+        )
+        categories = {**self.categories, "Uncategorized": {'name': 'Uncategorized', 'savePath': ''}}
+        for category in categories.keys():
             for status in self.TORRENT_STATUSES:
-                status_prop = f"is_{status}"
-                status_torrents = [
-                    t for t in category_torrents if getattr(TorrentStates, status_prop).fget(TorrentStates(t['state']))
-                ]
-                metrics.append({
-                    "name": f"{self.config['metrics_prefix']}_torrents_count",
-                    "value": len(status_torrents),
-                    "labels": {
-                        "status": status,
-                        "category": category,
-                    },
-                    "help": f"Number of torrents in status {status} under category {category}"
-                })
-
-        return metrics
+                torrents_count.add_metric([status, category], counts[(category, status)])
+
+        return [torrents_count]
 
     def get_qbittorrent_torrents_metrics(self):
         if not self.torrents:
             return []
 
-        metrics = []
+        labels = ["name", "category", "hash"]
+        families = []
+        for name, field, metric_type, help_text in TORRENT_METRIC_SPECS:
+            family = _FAMILY_BY_TYPE[metric_type](self._names[name], help_text, labels=labels)
+            families.append((field, family))
+
         for torrent in self.torrents:
-            metrics.extend([
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_added_on",
-                    "value": torrent["added_on"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Time (Unix Epoch) when the torrent was added to the client",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_availability",
-                    "value": torrent["availability"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Percentage of file pieces currently available",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_downloaded",
-                    "value": torrent["downloaded"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Amount of data downloaded",
-                    "type": "counter"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_num_complete",
-                    "value": torrent["num_complete"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Number of seeds in the swarm",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_num_incomplete",
-                    "value": torrent["num_incomplete"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Number of leechers in the swarm",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_num_leechs",
-                    "value": torrent["num_leechs"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Number of leechers connected to",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_num_seeds",
-                    "value": torrent["num_seeds"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Number of seeds connected to",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_ratio",
-                    "value": torrent["ratio"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Torrent share ratio. Max ratio value: 9999.",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_seeding_time",
-                    "value": torrent["seeding_time"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Torrent elapsed time while complete (seconds)",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_size",
-                    "value": torrent["size"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Total size (bytes) of files selected for download",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_total_size",
-                    "value": torrent["total_size"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Total size (bytes) of all file in this torrent (including unselected ones)",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_time_active",
-                    "value": torrent["time_active"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Total active time (seconds)",
-                    "type": "gauge"
-                },
-                {
-                    "name": f"{self.config['metrics_prefix']}_torrents_info_uploaded",
-                    "value": torrent["uploaded"],
-                    "labels": {
-                        "name": torrent["name"],
-                        "category": torrent["category"],
-                        "hash": torrent["hash"]
-                    },
-                    "help": f"Amount of data uploaded",
-                    "type": "counter"
-                },
-            ])
-
-        return metrics
+            label_values = [torrent["name"], torrent["category"], torrent["hash"]]
+            for field, family in families:
+                family.add_metric(label_values, torrent[field])
+
+        return [family for _, family in families]
+
+    def _fetch_torrent_peers(self, torrent):
+        try:
+            return self._sync_torrent_peers(torrent["hash"])
+        except Exception as e:
+            logger.error(f"Couldn't fetch torrent peers ({torrent['hash']}): {e}")
+            return None
 
     def get_qbittorrent_peers_metrics(self):
         if not self.torrents:
             return []
 
-        metrics = []
-        for torrent in self.torrents:
-            try:
-                torrent_peers = self.client.sync_torrent_peers(torrent_hash=torrent["hash"])
-            except Exception as e:
-                logger.error(f"Couldn't fetch torrent peers ({torrent['hash']}): {e}")
-                continue
+        # Peers are fetched one torrent at a time, so spread the requests over the pool
+        torrents_peers = self._pool.map(self._fetch_torrent_peers, self.torrents)
+
+        # Peer addresses rotate constantly, so unless asked otherwise peers are
+        # aggregated by country to keep the number of series bounded
+        peer_detail = self.config["export_peer_detail"]
+        labels = ["torrent_name", "torrent_hash", "country", "country_code"]
+        if peer_detail:
+            labels += ["ip", "port"]
+
+        # Per country sums drop whenever a peer leaves, so they can only be gauges
+        transferred_family = CounterMetricFamily if peer_detail else GaugeMetricFamily
+        downloaded = transferred_family(
+            self._names["peers_downloaded"],
+            "Amount of data downloaded by peers (currently connected ones unless peer detail is exported)",
+            labels=labels,
+        )
+        uploaded = transferred_family(
+            self._names["peers_uploaded"],
+            "Amount of data uploaded by peers (currently connected ones unless peer detail is exported)",
+            labels=labels,
+        )
+        progress = GaugeMetricFamily(
+            self._names["peers_progress"],
+            "Peers download progress (average by country unless peer detail is exported)",
+            labels=labels,
+        )
+        relevance = GaugeMetricFamily(
+            self._names["peers_relevance"],
+            "Peers relevance (average by country unless peer detail is exported)",
+            labels=labels,
+        )
 
-            peers = torrent_peers["peers"]
+        for torrent, peers in zip(self.torrents, torrents_peers):
             if not peers:
                 continue
 
+            # Shared by every sample of this torrent
+            torrent_labels = [torrent["name"], torrent["hash"]]
+
+            if peer_detail:
+                for peer in peers.values():
+                    label_values = [
+                        *torrent_labels,
+                        peer.get("country", ""),
+                        peer.get("country_code", ""),
+                        peer["ip"],
+                        str(peer["port"]),
+                    ]
+                    downloaded.add_metric(label_values, peer["downloaded"])
+                    uploaded.add_metric(label_values, peer["uploaded"])
+                    progress.add_metric(label_values, peer["progress"])
+                    relevance.add_metric(label_values, peer["relevance"])
+                continue
+
+            peers_count = Counter()
+            downloaded_total = Counter()
+            uploaded_total = Counter()
+            progress_total = Counter()
+            relevance_total = Counter()
             for peer in peers.values():
-                metrics.extend([
-                    {
-                        "name": f"{self.config['metrics_prefix']}_peers_downloaded",
-                        "value": peer["downloaded"],
-                        "labels": {
-                            "torrent_name": torrent["name"],
-                            "torrent_hash": torrent["hash"],
-                            "country": peer["country"],
-                            "country_code": peer["country_code"],
-                            "ip": peer["ip"],
-                            "port": str(peer["port"])
-                        },
-                        "help": f"Amount of data downloaded by peer",
-                        "type": "counter"
-                    },
-                    {
-                        "name": f"{self.config['metrics_prefix']}_peers_uploaded",
-                        "value": peer["uploaded"],
-                        "labels": {
-                            "torrent_name": torrent["name"],
-                            "torrent_hash": torrent["hash"],
-                            "country": peer["country"],
-                            "country_code": peer["country_code"],
-                            "ip": peer["ip"],
-                            "port": str(peer["port"])
-                        },
-                        "help": f"Amount of data uploaded by peer",
-                        "type": "counter"
-                    },
-                    {
-                        "name": f"{self.config['metrics_prefix']}_peers_progress",
-                        "value": peer["progress"],
-                        "labels": {
-                            "torrent_name": torrent["name"],
-                            "torrent_hash": torrent["hash"],
-                            "country": peer["country"],
-                            "country_code": peer["country_code"],
-                            "ip": peer["ip"],
-                            "port": str(peer["port"])
-                        },
-                        "type": "gauge"
-                    },
-                    {
-                        "name": f"{self.config['metrics_prefix']}_peers_relevance",
-                        "value": peer["relevance"],
-                        "labels": {
-                            "torrent_name": torrent["name"],
-                            "torrent_hash": torrent["hash"],
-                            "country": peer["country"],
-                            "country_code": peer["country_code"],
-                            "ip": peer["ip"],
-                            "port": str(peer["port"])
-                        },
-                        "type": "gauge"
-                    },
-            ])
-
-        return metrics
+                # Countries are missing when qBittorrent does not resolve them
+                country = (peer.get("country", ""), peer.get("country_code", ""))
+                peers_count[country] += 1
+                downloaded_total[country] += peer["downloaded"]
+                uploaded_total[country] += peer["uploaded"]
+                progress_total[country] += peer["progress"]
+                relevance_total[country] += peer["relevance"]
+
+            for country, count in peers_count.items():
+                label_values = [*torrent_labels, *country]
+                downloaded.add_metric(label_values, downloaded_total[country])
+                uploaded.add_metric(label_values, uploaded_total[country])
+                progress.add_metric(label_values, progress_total[country] / count)
+                relevance.add_metric(label_values, relevance_total[country] / count)
+
+        return [downloaded, uploaded, progress, relevance]
 
 class SignalHandler():
     def __init__(self):
-        self.shutdown = False
+        self._shutdown = threading.Event()
 
         # Register signal handler
         signal.signal(signal.SIGINT, self._on_signal_received)
         signal.signal(signal.SIGTERM, self._on_signal_received)
 
-    def is_shutting_down(self):
-        return self.shutdown
+    def wait(self):
+        self._shutdown.wait()
 
     def _on_signal_received(self, signal, frame):
         logger.info("Exporter is shutting down")
-        self.shutdown = True
+        self._shutdown.set()
+
+
+def _parse_number(value, parse):
+    try:
+        number = parse(value)
+    except ValueError:
+        return None
+
+    return number if math.isfinite(number) else None
 
 
 def main():
@@ -455,6 +591,10 @@ def main():
         "exporter_port": int(os.environ.get("EXPORTER_PORT", "8000")),
         "log_level": os.environ.get("EXPORTER_LOG_LEVEL", "INFO"),
         "metrics_prefix": os.environ.get("METRICS_PREFIX", "qbittorrent"),
+        "cache_ttl": os.environ.get("METRICS_CACHE_TTL", "300"),
+        "peers_concurrency": os.environ.get("PEERS_CONCURRENCY", "16"),
+        "collect_interval": os.environ.get("COLLECT_INTERVAL", "15"),
+        "export_peer_detail": os.environ.get("EXPORT_PEER_DETAIL", "0") == "1",
     }
 
     # Register signal handler
@@ -477,6 +617,21 @@ def main():
     if not config["port"]:
         logger.error("No post specified, please set QBITTORRENT_PORT environment variable")
         sys.exit(1)
+    if not re.fullmatch(r"[a-zA-Z_:][a-zA-Z0-9_:]*", config["metrics_prefix"]):
+        logger.error("Invalid metrics prefix, METRICS_PREFIX must be a valid Prometheus metric name")
+        sys.exit(1)
+    config["cache_ttl"] = _parse_number(config["cache_ttl"], float)
+    if config["cache_ttl"] is None or config["cache_ttl"] < 0:
+        logger.error("Invalid cache TTL, METRICS_CACHE_TTL must be a number of seconds of at least 0")
+        sys.exit(1)
+    config["peers_concurrency"] = _parse_number(config["peers_concurrency"], int)
+    if config["peers_concurrency"] is None or config["peers_concurrency"] < 1:
+        logger.error("Invalid peers concurrency, PEERS_CONCURRENCY must be an integer of at least 1")
+        sys.exit(1)
+    config["collect_interval"] = _parse_number(config["collect_interval"], float)
+    if config["collect_interval"] is None or config["collect_interval"] <= 0:
+        logger.error("Invalid collect interval, COLLECT_INTERVAL must be a number of seconds greater than 0")
+        sys.exit(1)
 
     # Register our custom collector
     logger.info("Exporter is starting up")
@@ -488,7 +643,7 @@ def main():
         f"Exporter listening on port {config['exporter_port']}"
     )
 
-    while not signal_handler.is_shutting_down():
-        time.sleep(1)
+    # Block until a shutdown signal is received
+    signal_handler.wait()
 
     logger.info("Exporter has shutdown")
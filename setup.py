@@ -17,7 +17,7 @@ setup(
     keywords=['prometheus', 'qbittorrent'],
     classifiers=[],
     python_requires='>=3',
-    install_requires=['qbittorrent-api==2021.4.20', 'prometheus_client==0.10.1', 'python-json-logger==2.0.1', 'attrdict'],
+    install_requires=['qbittorrent-api==2021.4.20', 'prometheus_client==0.10.1', 'python-json-logger==2.0.1', 'orjson'],
     entry_points={
         'console_scripts': [
             'qbittorrent-exporter=qbittorrent_exporter.exporter:main',